@@ -8,6 +8,7 @@ coordinate so the frontend only has to drop markers.
 
 Usage:
     run.py --series <dicom_dir> --out <result.json> [--task total_mr]
+           [--device gpu|gpu:N|cpu|mps]
 
 Contract (stdout is logs; the JSON is written to --out):
     {
@@ -20,9 +21,9 @@ Contract (stdout is logs; the JSON is written to --out):
     }
 
 This runs fully locally (no network at inference time once weights are present),
-consistent with the privacy-first design. It is packaged as a standalone binary
-via PyInstaller (see mr_segmentation.spec) and downloaded on demand by the app;
-nothing here is bundled in the installer.
+consistent with the privacy-first design. It is not frozen or bundled in the
+installer: the app provisions a Python env on demand and runs this script with
+it (see src-tauri/src/mr_seg.rs and README.md).
 
 NOTE: the voxel -> DICOM (instance, x, y) mapping assumes the segmentation is
 produced in the input series' geometry. Validate the axis conventions and any
@@ -37,7 +38,6 @@ import sys
 from pathlib import Path
 
 import numpy as np
-import pydicom
 
 
 # Labels we surface as markers. TotalSegmentator-MRI names vertebrae like
@@ -50,11 +50,39 @@ VERTEBRA_LABELS = (
 )
 
 
+# The only header elements the engine reads: Rows identifies image instances,
+# SeriesInstanceUID filters a study folder, the rest drive slice sorting and the
+# voxel -> (instance, x, y) mapping. Keep in sync with load_series/_slice_geometry.
+_HEADER_TAGS = (
+    "Rows",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "InstanceNumber",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "PixelSpacing",
+)
+
+
 def short_label(seg_label: str) -> str:
     """'vertebrae_L1' -> 'L1' (fall back to the raw label)."""
     return seg_label.split("_", 1)[1] if seg_label.startswith("vertebrae_") else seg_label
 
 
+def _read_header(path: Path):
+    """Read one file's DICOM header, or None if it isn't readable DICOM. Reads
+    metadata only (stop_before_pixels), and only the tags we use, for speed; TS
+    reads the pixels later."""
+    import pydicom
+
+    try:
+        return pydicom.dcmread(
+            str(path), stop_before_pixels=True, specific_tags=list(_HEADER_TAGS)
+        )
+    except Exception:
+        return None
+
+
 def load_series(series_dir: Path, series_uid: str | None):
     """Load + sort a DICOM series, returning (datasets, file_paths) ordered
     along the volume axis.
@@ -63,17 +91,20 @@ def load_series(series_dir: Path, series_uid: str | None):
     `series_uid` is given, only instances of that series are kept. The k (slice)
     index used to map segmentation voxels back to slices is defined by this sort.
     """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
     items = []  # (dataset, path)
     # Walk RECURSIVELY: the selected folder is often a study/library root with
     # the images nested (e.g. <study>/IMAGES/DICOM/S0001/SER0001/I0000001), and
-    # may hold several series — so we gather everything and filter by UID. Read
-    # metadata only (stop_before_pixels) for speed; TS reads the pixels later.
-    for path in series_dir.rglob("*"):
-        if not path.is_file():
-            continue
-        try:
-            ds = pydicom.dcmread(str(path), stop_before_pixels=True)
-        except Exception:
+    # may hold several series — so we gather everything and filter by UID.
+    files = [p for p in series_dir.rglob("*") if p.is_file()]
+    # Header reads are independent and mostly waiting on file I/O (which
+    # releases the GIL), so overlap them; map() keeps the walk order.
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+        headers = list(pool.map(_read_header, files))
+    for path, ds in zip(files, headers):
+        if ds is None:
             continue  # skip non-DICOM / unreadable files
         # Image instances have Rows/Columns; skips reports (SR), DICOMDIR, etc.
         if getattr(ds, "Rows", None) is None:
@@ -101,19 +132,43 @@ def load_series(series_dir: Path, series_uid: str | None):
     return datasets, paths
 
 
-def stage_series(paths, work_dir: Path) -> Path:
-    """Copy the selected series' files into an isolated input dir so
-    TotalSegmentator reads exactly one series (not the whole study folder)."""
+def stage_series(paths, work_dir: Path, series_dir: Path) -> Path:
+    """Stage the selected series' files into an isolated input dir so
+    TotalSegmentator reads exactly one series (not the whole study folder).
+
+    Files are hard-linked rather than copied, so staging a large series doesn't
+    duplicate its pixel data on disk or in the page cache. Falls back to a copy
+    when linking isn't possible (different volume, filesystem without links).
+    """
+    import os
     import shutil
+    import tempfile
 
-    input_dir = work_dir / "input"
-    input_dir.mkdir(parents=True, exist_ok=True)
+    # Staging inside the series would mix our links into the user's folder.
+    work = work_dir.resolve()
+    series = series_dir.resolve()
+    if work == series or series in work.parents:
+        raise SystemExit(f"work dir must not be inside the series dir: {work_dir}")
+
+    # Always stage into a FRESH dir we created. A reused --work-dir may hold an
+    # earlier run's links (writing through one would overwrite THAT series'
+    # originals) or even the user's own files, so nothing here is cleared.
+    work_dir.mkdir(parents=True, exist_ok=True)
+    input_dir = Path(tempfile.mkdtemp(prefix="input-", dir=work_dir))
     for i, p in enumerate(paths):
-        shutil.copy2(str(p), str(input_dir / f"{i:05d}.dcm"))
+        dest = input_dir / f"{i:05d}.dcm"
+        try:
+            os.link(str(p), str(dest))
+        except FileExistsError:
+            raise  # never fall through to copying into an existing (linked) file
+        except OSError:
+            shutil.copy2(str(p), str(dest))  # linking unsupported here
     return input_dir
 
 
-def run_totalsegmentator(series_dir: Path, work_dir: Path, task: str, out_name: str = "seg"):
+def run_totalsegmentator(
+    series_dir: Path, work_dir: Path, task: str, out_name: str = "seg", device: str = "gpu"
+):
     """Run TotalSegmentator-MRI; return (seg_img, label_names, version).
 
     `seg_img` is the nibabel image (multi-label volume) with its affine, so
@@ -123,7 +178,6 @@ def run_totalsegmentator(series_dir: Path, work_dir: Path, task: str, out_name:
     """
     from totalsegmentator.python_api import totalsegmentator
     import totalsegmentator as ts_pkg
-    import nibabel as nib
 
     out_dir = work_dir / out_name
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -133,19 +187,25 @@ def run_totalsegmentator(series_dir: Path, work_dir: Path, task: str, out_name:
     # path and keep input geometry so voxel indices line up with the sorted DICOM
     # slices.
     seg_path = out_dir / "segmentation.nii"
-    totalsegmentator(
+    seg = totalsegmentator(
         str(series_dir),
         str(seg_path),
         task=task,
         ml=True,
+        device=device,
     )
 
-    # Be defensive about the exact name/extension TS chooses (.nii vs .nii.gz).
-    candidates = [seg_path, *out_dir.glob("*.nii*"), *work_dir.glob(f"{out_name}*.nii*")]
-    seg_file = next((p for p in candidates if p.exists()), None)
-    if seg_file is None:
-        raise SystemExit("TotalSegmentator produced no segmentation output")
-    seg = nib.load(str(seg_file))
+    # TS returns the in-memory image it just wrote; use it rather than reading
+    # the volume back from disk. Older releases return None — fall back to the file.
+    if seg is None:
+        import nibabel as nib
+
+        # Be defensive about the exact name/extension TS chooses (.nii vs .nii.gz).
+        candidates = [seg_path, *out_dir.glob("*.nii*"), *work_dir.glob(f"{out_name}*.nii*")]
+        seg_file = next((p for p in candidates if p.exists()), None)
+        if seg_file is None:
+            raise SystemExit("TotalSegmentator produced no segmentation output")
+        seg = nib.load(str(seg_file))
 
     # Map label ids -> names via the bundled class map for the task.
     try:
@@ -186,28 +246,68 @@ def _slice_geometry(ds):
     )
 
 
-def _world_to_pixel(world_lps, geoms):
+def _slice_offsets(geoms):
+    """Each slice's position along the shared slice normal (mm), in `geoms`
+    order. Computed once per series so landmark lookups are a single argmin."""
+    if not geoms:
+        return np.empty(0)
+    normal = geoms[0][1][3]
+    return np.array([float(np.dot(g[0], normal)) for _i, g in geoms])
+
+
+def _world_to_pixel(world_lps, geoms, offsets):
     """Map a patient-space point (LPS, mm) to the nearest slice + pixel.
 
-    `geoms` is a list of (slice_index, geometry). Returns (slice_index, col, row)
-    or None. Slices are parallel, so the nearest one is found by projecting onto
-    the shared slice normal.
+    `geoms` is a list of (slice_index, geometry) and `offsets` the matching
+    `_slice_offsets(geoms)`. Returns (slice_index, col, row) or None. Slices are
+    parallel, so the nearest one is found by projecting onto the shared normal.
     """
     if not geoms:
         return None
     normal = geoms[0][1][3]
     t_p = float(np.dot(world_lps, normal))
-    idx, (ipp, e_col, e_row, _n, col_sp, row_sp) = min(
-        geoms, key=lambda g: abs(float(np.dot(g[1][0], normal)) - t_p)
-    )
+    nearest = int(np.argmin(np.abs(offsets - t_p)))
+    idx, (ipp, e_col, e_row, _n, col_sp, row_sp) = geoms[nearest]
     d = world_lps - ipp
     col = float(np.dot(d, e_col)) / col_sp if col_sp else 0.0
     row = float(np.dot(d, e_row)) / row_sp if row_sp else 0.0
     return idx, int(round(col)), int(round(row))
 
 
-def landmark_from_mask(mask, affine, slices, geoms, anterior_bias=False):
-    """Resolve a boolean voxel mask's centroid to a DICOM (instance, x, y).
+def group_labels(vol, label_ids):
+    """Gather the voxels of `label_ids` from a multi-label volume in ONE pass.
+
+    Returns a table of flat voxel indices sorted by label, so each structure's
+    voxels are a contiguous slice (see `label_voxels`) instead of a full-volume
+    compare per label. The table holds only the requested labels (for the
+    vertebra ids, a few percent of the volume); keeping flat indices (not
+    ii/jj/kk) means one array to permute, and coordinates are only decoded for
+    the labels we actually surface.
+    """
+    # Flatten in the array's own memory order so ravel() is a view, not a copy
+    # (nibabel volumes are usually Fortran-ordered).
+    order = "F" if vol.flags.f_contiguous and not vol.flags.c_contiguous else "C"
+    flat = vol.ravel(order=order)
+    # Only the requested labels enter the table; other structures (discs, cord,
+    # organs) are dropped in the same pass. For integer volumes isin() uses a
+    # lookup table, so this is a single linear scan.
+    idx = np.flatnonzero(np.isin(flat, label_ids))
+    labels = flat[idx]
+    # Stable sort on a small integer dtype is a linear-time radix sort in NumPy.
+    perm = np.argsort(labels, kind="stable")
+    return idx[perm], labels[perm], vol.shape, order
+
+
+def label_voxels(groups, label_id):
+    """Voxel index arrays (ii, jj, kk) of one label from `group_labels`."""
+    idx, labels, shape, order = groups
+    lo = np.searchsorted(labels, label_id, side="left")
+    hi = np.searchsorted(labels, label_id, side="right")
+    return np.unravel_index(idx[lo:hi], shape, order=order)
+
+
+def landmark_from_voxels(ii, jj, kk, affine, slices, geoms, offsets, anterior_bias=False):
+    """Resolve a structure's voxel centroid to a DICOM (instance, x, y).
 
     Uses the segmentation's affine to map the centroid to patient space, then
     each slice's DICOM geometry to find the slice + pixel — orientation-agnostic,
@@ -215,21 +315,23 @@ def landmark_from_mask(mask, affine, slices, geoms, anterior_bias=False):
     (they don't; dicom2nifti reorients). Returns a landmark dict or None.
 
     With `anterior_bias`, the centroid is computed over the anterior ~half of the
-    mask so a whole-vertebra label (body + posterior arch) lands on the body.
+    voxels so a whole-vertebra label (body + posterior arch) lands on the body.
     "Anterior" is derived from the affine (RAS +Y), so it's orientation-correct.
     """
-    if not mask.any():
+    if ii.size == 0:
         return None
-    ii, jj, kk = np.nonzero(mask)
-    if anterior_bias and ii.size:
-        coords = np.vstack([ii, jj, kk, np.ones(ii.size)]).astype(float)
-        ras_y = (affine @ coords)[1]  # RAS +Y = anterior; larger = more anterior
-        sel = ras_y >= np.median(ras_y)  # keep the anterior half (the body)
-        if sel.any():
-            ii, jj, kk = ii[sel], jj[sel], kk[sel]
+    if anterior_bias:
+        # Only the RAS +Y row of the affine matters here (larger = more
+        # anterior); the translation term is constant so it can't move the median.
+        a = affine[1]
+        ras_y = a[0] * ii + a[1] * jj + a[2] * kk
+        # Keep the anterior half (the body). The median never exceeds the max, so
+        # this is never empty; resolve the mask to indices once, not per axis.
+        sel = np.flatnonzero(ras_y >= np.median(ras_y))
+        ii, jj, kk = ii[sel], jj[sel], kk[sel]
     centroid = np.array([ii.mean(), jj.mean(), kk.mean(), 1.0])
     world_lps = (affine @ centroid)[:3] * _RAS_TO_LPS
-    hit = _world_to_pixel(world_lps, geoms)
+    hit = _world_to_pixel(world_lps, geoms, offsets)
     if hit is None:
         return None
     idx, col, row = hit
@@ -241,10 +343,14 @@ def landmark_from_mask(mask, affine, slices, geoms, anterior_bias=False):
     }
 
 
-def segment(series_dir: Path, work_dir: Path, task: str, series_uid: str | None) -> dict:
+def segment(
+    series_dir: Path, work_dir: Path, task: str, series_uid: str | None, device: str = "gpu"
+) -> dict:
     slices, paths = load_series(series_dir, series_uid)
-    input_dir = stage_series(paths, work_dir)
-    seg, label_names, version = run_totalsegmentator(input_dir, work_dir, task, out_name="seg")
+    input_dir = stage_series(paths, work_dir, series_dir)
+    seg, label_names, version = run_totalsegmentator(
+        input_dir, work_dir, task, out_name="seg", device=device
+    )
     vol = np.asanyarray(seg.dataobj)
 
     # Per-slice geometry for mapping voxel centroids back to DICOM space.
@@ -253,21 +359,25 @@ def segment(series_dir: Path, work_dir: Path, task: str, series_uid: str | None)
         for i, ds in enumerate(slices)
         if (g := _slice_geometry(ds)) is not None
     ]
+    offsets = _slice_offsets(geoms)
 
     # Invert name->id, restricted to the vertebra labels we surface.
     name_to_id = {name: lid for lid, name in label_names.items()}
+    wanted = [(lbl, name_to_id[lbl]) for lbl in VERTEBRA_LABELS if lbl in name_to_id]
+    # Tasks without per-vertebra labels (e.g. total_mr) resolve no ids; don't
+    # build a voxel table just to throw it away.
+    groups = group_labels(vol, [lid for _, lid in wanted]) if wanted else None
 
     structures = []
-    for seg_label in VERTEBRA_LABELS:
-        label_id = name_to_id.get(seg_label)
-        if label_id is None:
-            continue
-        mask = vol == label_id
+    for seg_label, label_id in wanted:
+        ii, jj, kk = label_voxels(groups, label_id)
         # `vertebrae_mr` labels the WHOLE vertebra (body + posterior arch), so its
         # raw centroid sits behind the body. Bias toward the vertebral body, which
         # is the ANTERIOR portion (the dedicated `vertebrae_body` task would be
         # cleaner but requires a TotalSegmentator license).
-        landmark = landmark_from_mask(mask, seg.affine, slices, geoms, anterior_bias=True)
+        landmark = landmark_from_voxels(
+            ii, jj, kk, seg.affine, slices, geoms, offsets, anterior_bias=True
+        )
         if landmark is None or not landmark["sopInstanceUID"]:
             continue
         landmark["label"] = short_label(seg_label)
@@ -283,6 +393,16 @@ def segment(series_dir: Path, work_dir: Path, task: str, series_uid: str | None)
     }
 
 
+def _device(value: str) -> str:
+    """argparse type for --device: the values TotalSegmentator accepts, checked
+    up front so a typo fails before the study folder is walked and staged."""
+    if value in ("gpu", "cpu", "mps"):
+        return value
+    if value.startswith("gpu:") and value[4:].isdigit():
+        return value
+    raise argparse.ArgumentTypeError(f"expected gpu, gpu:N, cpu or mps, got {value!r}")
+
+
 def main(argv=None) -> int:
     parser = argparse.ArgumentParser(description="OpenScans MR segmentation engine")
     parser.add_argument("--series", required=True, help="DICOM series or study directory")
@@ -297,25 +417,45 @@ def main(argv=None) -> int:
         default=None,
         help="restrict to this SeriesInstanceUID when --series is a study folder",
     )
-    parser.add_argument("--work-dir", default=None, help="scratch dir (default: temp)")
+    # TotalSegmentator device: "gpu" (CUDA, falls back to CPU when unavailable),
+    # "gpu:N", "cpu", or "mps" (Apple Silicon, experimental). It has no
+    # reduced-precision option. Dev-only for now: the app (mr_seg.rs) doesn't pass
+    # it, so in-app runs use TotalSegmentator's own default, "gpu".
+    parser.add_argument(
+        "--device", default="gpu", type=_device, help="gpu, gpu:N, cpu or mps (default: gpu)"
+    )
+    parser.add_argument(
+        "--work-dir", default=None, help="scratch dir, kept after the run (default: temp)"
+    )
     args = parser.parse_args(argv)
 
     series_dir = Path(args.series)
     if not series_dir.is_dir():
         print(f"error: series dir not found: {series_dir}", file=sys.stderr)
         return 2
+    # Check where the result goes BEFORE the minutes-long segmentation, not after.
+    out_path = Path(args.out)
+    if not out_path.parent.is_dir():
+        print(f"error: output dir not found: {out_path.parent}", file=sys.stderr)
+        return 2
 
+    import shutil
     import tempfile
 
     work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="mrseg-"))
     try:
-        result = segment(series_dir, work_dir, args.task, args.series_uid)
+        result = segment(series_dir, work_dir, args.task, args.series_uid, args.device)
     except SystemExit as e:
         print(f"error: {e}", file=sys.stderr)
         return 1
-
-    Path(args.out).write_text(json.dumps(result, indent=2))
-    print(f"Wrote {len(result['structures'])} structures to {args.out}")
+    finally:
+        # The scratch dir holds the staged series and the full-size segmentation;
+        # drop it unless the caller asked to keep it via --work-dir.
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    out_path.write_text(json.dumps(result, indent=2))
+    print(f"Wrote {len(result['structures'])} structures to {out_path}")
     return 0
 
 